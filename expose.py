@@ -5,8 +5,9 @@ process photos and videos into a static site photojournal
 https://github.com/mplewis/expose.py
 
 Usage:
-    expose.py [--verbose --dry-run --site-only]
+    expose.py [--verbose --dry-run --site-only --preview]
     expose.py [--dry-run] --create-template
+    expose.py [--dry-run] --fetch-assets
     expose.py --help
     expose.py --version
     expose.py --paths
@@ -18,7 +19,11 @@ Options:
     -v, --verbose          Enable verbose log messages
     -d, --dry-run          Log all actions but don't execute them
     -s, --site-only        Skip rendering and just build HTML
+    -p, --preview          Build the site from small, fast renders first,
+                           then refine them at full quality
     -c, --create-template  Create a blank metadata.yml for source files
+    -f, --fetch-assets     Download the template's pinned third-party assets
+                           into its vendor/ directory
 """
 VERSION = 'expose.py 0.0.1'
 
@@ -26,22 +31,35 @@ VERSION = 'expose.py 0.0.1'
 import pyprind
 from docopt import docopt
 from jinja2 import Environment, FileSystemLoader
+from markdown import markdown
+
+# Optional deps
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # System deps
+import gzip
 import hashlib
 import json
 import yaml
 import re
 import logging as l
 from multiprocessing import Pool, Manager
-from os import getcwd, makedirs
+from os import getcwd, getpid, makedirs, remove, replace, scandir, sep
 from os.path import (join, basename, splitext, isfile, split, dirname,
-                     realpath, isdir)
+                     realpath, relpath, isdir)
+from fnmatch import fnmatchcase
+from time import mktime, strptime
+from calendar import timegm
+from datetime import datetime
 from glob import glob
 from subprocess import check_call, check_output
 from collections import (namedtuple, OrderedDict)
 from sys import exit
-from shutil import copy
+from shutil import copy, rmtree
+from urllib.request import urlopen
 
 # Templates are relative to the script, not the source directory
 SCRIPT_DIR = dirname(realpath(__file__))
@@ -80,6 +98,8 @@ VIDEO_FMT_COMMANDS = {
         '-b:v {bitrate}M '
         '-maxrate {max_bitrate}M '
         '-bufsize {max_bitrate}M '
+        '-deadline {vp8_deadline} '
+        '-cpu-used {vp8_cpu_used} '
         '-f webm '
         '"{dst}"'
     ),
@@ -91,8 +111,49 @@ VIDEO_FMT_EXTS = {
     'webm': '.webm'
 }
 
+# Encoder settings for full-quality and preview renders. Previews trade
+# quality and file size for encoding speed. An image quality of None leaves
+# the choice to ImageMagick.
+ENCODE_SETTINGS = {
+    'full': {
+        'image_quality': None,
+        'h264_encode_speed': 'medium',
+        'vp8_deadline': 'good',
+        'vp8_cpu_used': 0,
+    },
+    'preview': {
+        'image_quality': 60,
+        'h264_encode_speed': 'ultrafast',
+        'vp8_deadline': 'realtime',
+        'vp8_cpu_used': 8,
+    },
+}
+
+# Preview builds only render this many of the smallest resolutions
+PREVIEW_RESOLUTIONS = 2
+
 METADATA_FILENAME = 'metadata.yml'
 
+# Records each source's stat data and rendered slices, so a build only has to
+# look at sources that changed. Delete it to force every source to be checked.
+INDEX_FILENAME = '.expose-index.json'
+
+# The file extensions of rendered slices
+SLICE_EXTS = ('.jpg', '.mp4', '.webm')
+
+# Each template lists the scripts, styles and files it needs in this manifest
+ASSETS_FILENAME = 'assets.yml'
+
+# Third-party assets live in this directory inside the template. Commit them
+# there so builds work offline; missing ones are fetched from their pinned URL.
+VENDOR_DIRNAME = 'vendor'
+
+# All of a template's scripts are concatenated into this one file
+BUNDLE_FILENAME = 'bundle.min.js'
+
+# Site files that get .gz (and .br, if brotli is installed) siblings
+PRECOMPRESS_PATTERNS = ['*.html', '*.js', '*.css', '*.json']
+
 # Config is a named tuple that's passed between most of these methods. It
 # makes it easier to work with a runtime config without making the config a
 # global.
@@ -104,13 +165,24 @@ Config = namedtuple('Config', ('SRC_DIR '
                                'RESOLUTIONS '
                                'VIDEO_FORMATS '
                                'VIDEO_BITRATES '
-                               'VIDEO_VBR_MAX_RATIO'))
+                               'VIDEO_VBR_MAX_RATIO '
+                               'SORT_ORDER'))
+
+# SourceFile is a named tuple for a single source image/video found while
+# scanning the source directory, along with the stat data used to tell if it
+# changed since the last build.
+SourceFile = namedtuple('SourceFile', ('path rel size mtime is_video'))
 
 # ImageJob and VideoJob are named tuples that hold info on a single image/video
 # output target job. They're easy to pass around multithreading pools.
-ImageJob = namedtuple('ImageJob', ('src dst size dry_run'))
+ImageJob = namedtuple('ImageJob', ('src dst size preview dry_run'))
 VideoJob = namedtuple('VideoJob', ('cfg src dst format resolution bitrate '
-                                   'dry_run'))
+                                   'preview dry_run'))
+
+
+def slice_width(path):
+    """Get the width of a rendered slice off its filename: *-WIDTH.*"""
+    return int(re.match(r'^.+-(\d+)\..+$', path).groups()[0])
 
 
 class WebMediaSlice:
@@ -124,9 +196,8 @@ class WebMediaSlice:
     def __init__(self, source):
         """Create a WebMediaSlice from a full path to an output file."""
         self.source = source
-        # Grab the width off the filename: *-WIDTH.*
         _, self.name = split(source)
-        self.width = int(re.match(r'^.+-(\d+)\..+$', source).groups()[0])
+        self.width = slice_width(source)
 
     def __repr__(self):
         media_type = 'image'
@@ -142,10 +213,15 @@ class WebMediaSlice:
 
 class WebMedia:
     """A bundle of WebMediaSlices that corresponds to an input file."""
-    def __init__(self, directory, sources):
-        """Create a WebMedia object from a set of output files."""
+    def __init__(self, directory, sources, name, path):
+        """
+        Create a WebMedia object from a set of output files. The name is the
+        slide name used in metadata.yml, and the path is the output directory
+        relative to the site root.
+        """
         self.directory = directory
-        _, self.name = split(directory)
+        self.name = name
+        self.path = path
         self.slices = [WebMediaSlice(source) for source in sources]
 
     def __repr__(self):
@@ -163,20 +239,72 @@ class WebMedia:
         return False
 
 
-def src_images(cfg):
-    """List the paths to source images."""
-    images = []
-    for pattern in cfg.IMAGE_PATTERNS:
-        images.extend(glob(join(cfg.SRC_DIR, pattern)))
-    return images
+def matches_any(name, patterns):
+    """True if a filename matches any of the given glob patterns."""
+    return any(fnmatchcase(name, pattern) for pattern in patterns)
+
+
+def scan_sources(cfg):
+    """
+    Walk the source directory tree once and list every source image and
+    video, sorted by path. The stat data comes from the same directory scan,
+    so this never has to open a file. Hidden directories, the output
+    directory and files or directories that can't be read are skipped.
+    Sources whose slide name is already taken are skipped too.
+    """
+    sources = []
+    dst_dir = realpath(cfg.DST_DIR)
+    dirs = [cfg.SRC_DIR]
+    while dirs:
+        directory = dirs.pop()
+        try:
+            entries = scandir(directory)
+        except PermissionError as e:
+            l.warning('Skipping {}: {}'.format(directory, e))
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if realpath(entry.path) != dst_dir:
+                        dirs.append(entry.path)
+                    continue
+                is_video = matches_any(entry.name, cfg.VIDEO_PATTERNS)
+                if not (is_video or
+                        matches_any(entry.name, cfg.IMAGE_PATTERNS)):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError as e:
+                    # e.g. a symlink pointing nowhere
+                    l.warning('Skipping {}: {}'.format(entry.path, e))
+                    continue
+                sources.append(SourceFile(
+                    entry.path, relpath(entry.path, cfg.SRC_DIR),
+                    stat.st_size, stat.st_mtime_ns, is_video))
+
+    # Sources with the same slide name would share an output directory, e.g.
+    # foo.jpg and foo.mp4, so only the first one by path is kept
+    unique = OrderedDict()
+    for source in sorted(sources):
+        name = slide_name(cfg, source.path)
+        if name in unique:
+            l.warning('Skipping {}: its slide name {} is already used by {}'
+                      .format(source.rel, name, unique[name].rel))
+            continue
+        unique[name] = source
+    return list(unique.values())
+
 
+def src_images(sources):
+    """List the source images out of a set of scanned sources."""
+    return [s for s in sources if not s.is_video]
 
-def src_videos(cfg):
-    """List the paths to source videos."""
-    videos = []
-    for pattern in cfg.VIDEO_PATTERNS:
-        videos.extend(glob(join(cfg.SRC_DIR, pattern)))
-    return videos
+
+def src_videos(sources):
+    """List the source videos out of a set of scanned sources."""
+    return [s for s in sources if s.is_video]
 
 
 def mkdir_for_dst(dst, dry_run):
@@ -188,32 +316,60 @@ def mkdir_for_dst(dst, dry_run):
         makedirs(out_dir, exist_ok=True)
 
 
+def partial_path(dst):
+    """
+    Get a hidden path to render an output file to before moving it into
+    place, so a site being browsed never sees a half-written file.
+    """
+    path, name = split(dst)
+    return join(path, '.part-{}-{}'.format(getpid(), name))
+
+
+def finish_output(job, partial):
+    """
+    Move a rendered output into place and write its hash. Previews are marked
+    before they're in place, so an interrupted render never leaves a preview
+    that looks like a full-quality output. The mark is only cleared once a
+    full render has written its hash.
+    """
+    if job.preview:
+        mark_preview(job.dst, True)
+    replace(partial, job.dst)
+    write_hash(job.src, job.dst)
+    if not job.preview:
+        mark_preview(job.dst, False)
+
+
 def convert_image(job):
     """Convert a single output image designated by an ImageJob."""
-    mkdir_for_dst(job.dst, dry_run)
-    cmd = ['convert', job.src,
-           '-resize', '{}x>'.format(job.size),
-           job.dst]
+    mkdir_for_dst(job.dst, job.dry_run)
+    settings = ENCODE_SETTINGS[render_quality(job.preview)]
+    partial = partial_path(job.dst)
+    cmd = ['convert', job.src, '-resize', '{}x>'.format(job.size)]
+    if settings['image_quality']:
+        cmd.extend(['-quality', str(settings['image_quality'])])
+    cmd.append(partial)
     if job.dry_run:
         l.info('Dry run: {}'.format(' '.join(cmd)))
     else:
         check_call(cmd)
-        write_hash(job.src, job.dst)
+        finish_output(job, partial)
 
 
 def convert_video(job):
     """Convert a single output video designated by a VideoJob."""
 
     # First create the output video
-    mkdir_for_dst(job.dst, dry_run)
-    options = dict(
+    mkdir_for_dst(job.dst, job.dry_run)
+    partial = partial_path(job.dst)
+    options = dict(ENCODE_SETTINGS[render_quality(job.preview)])
+    options.update(
         src=job.src,
-        dst=job.dst,
+        dst=partial,
         resolution=job.resolution,
         bitrate=job.bitrate,
         max_bitrate=job.bitrate * job.cfg.VIDEO_VBR_MAX_RATIO,
         threads=2,
-        h264_encode_speed='medium',
     )
     cmd_template = VIDEO_FMT_COMMANDS[job.format]
     cmd = cmd_template.format(**options)
@@ -222,23 +378,24 @@ def convert_video(job):
     else:
         check_call(cmd, shell=True)
 
-    # Then create the cover image
+    # Then create the cover image. Every format at this resolution shares
+    # one poster, so only the first format's job makes it, unless it's
+    # missing altogether.
     name, ext = splitext(job.dst)
     poster_dst = name + '.jpg'
-
-    # One of the other video targets may have already made the poster for this
-    # video resolution
-    if not isfile(poster_dst):
-        cmd = ('ffmpeg -loglevel error -i "{}" -vframes 1 -f image2 "{}"'
-               .format(job.dst, poster_dst))
+    if job.format == job.cfg.VIDEO_FORMATS[0] or not isfile(poster_dst):
+        poster_partial = partial_path(poster_dst)
+        cmd = ('ffmpeg -loglevel error -y -i "{}" -vframes 1 -f image2 "{}"'
+               .format(partial, poster_partial))
         if job.dry_run:
             l.info('Dry run: {}'.format(cmd))
         else:
             check_call(cmd, shell=True)
+            replace(poster_partial, poster_dst)
 
     if not job.dry_run:
-        # Hash only gets written when the video and its poster image are done
-        write_hash(job.src, job.dst)
+        # The video only goes into place once its poster image is done
+        finish_output(job, partial)
 
 
 def convert_image_wrap(queue_and_job):
@@ -256,15 +413,6 @@ def convert_video_wrap(queue_and_job):
     queue.put(True)
 
 
-def sanitary_name(src):
-    """
-    Sanitize a name for conversion. Replace whitespace with hyphens.
-    Returns basename ONLY.
-    """
-    name, _ = sanitary_name_and_ext(src)
-    return name
-
-
 def sanitary_name_and_ext(src):
     """
     Sanitize a name for conversion. Replace whitespace with hyphens.
@@ -274,9 +422,63 @@ def sanitary_name_and_ext(src):
     return '-'.join(name.split()), ext
 
 
+def slide_name(cfg, src):
+    """
+    Get the slide name for a source media file: its sanitized path relative
+    to the source directory, without the extension. Files at the top of the
+    source directory are named after just their basename.
+    """
+    rel, _ = splitext(relpath(src, cfg.SRC_DIR))
+    return '/'.join('-'.join(part.split()) for part in rel.split(sep))
+
+
 def target_dir(cfg, src):
-    """Get the target directory path for a source media file."""
-    return join(cfg.DST_DIR, sanitary_name(src))
+    """
+    Get the target directory path for a source media file. Output is sharded
+    into 256 directories by a hash of the slide name, so no directory ends up
+    holding an entry for every source file.
+    """
+    name = slide_name(cfg, src)
+    shard = hashlib.sha1(name.encode()).hexdigest()[:2]
+    return join(cfg.DST_DIR, shard, *name.split('/'))
+
+
+def capture_time(source):
+    """
+    Get the time a photo or video was captured, in seconds since the epoch.
+    Images use their EXIF capture time, taken to be in the local time zone
+    unless EXIF records an offset. Videos use their container creation time,
+    which is always UTC. Falls back to the file's modification time.
+    """
+    try:
+        if source.is_video:
+            cmd = ('ffprobe -v error -show_entries format_tags=creation_time '
+                   '-of json "{}"'.format(source.path))
+            output = json.loads(check_output(cmd, shell=True).decode())
+            # 2015-06-12T14:03:22.000000Z
+            created = output['format']['tags']['creation_time'][:19]
+            return timegm(strptime(created, '%Y-%m-%dT%H:%M:%S'))
+        cmd = ('identify -format '
+               '"%[EXIF:DateTimeOriginal]|%[EXIF:OffsetTimeOriginal]" "{}"'
+               .format(source.path))
+        # 2015:06:12 14:03:22|+02:00
+        output = check_output(cmd, shell=True).decode().strip()
+        taken, offset = output.split('|')
+        if offset:
+            return datetime.strptime(taken + offset.replace(':', ''),
+                                     '%Y:%m:%d %H:%M:%S%z').timestamp()
+        return mktime(strptime(taken, '%Y:%m:%d %H:%M:%S'))
+    except Exception:
+        return source.mtime / 1e9
+
+
+def capture_times(sources):
+    """Get the capture times for a list of sources, probing in parallel."""
+    if not sources:
+        return []
+    l.info('Reading capture times for {} sources'.format(len(sources)))
+    with Pool() as pool:
+        return pool.map(capture_time, sources)
 
 
 def dimensions(src):
@@ -310,6 +512,41 @@ def hash_path_for_dst(dst):
     return join(path, '.' + name + '.src.sha256')
 
 
+def preview_path_for_dst(dst):
+    """Get the path of the marker file for a preview output file."""
+    path, name = split(dst)
+    return join(path, '.' + name + '.preview')
+
+
+def mark_preview(dst, preview):
+    """Mark an output file as a preview render, or clear the mark."""
+    marker = preview_path_for_dst(dst)
+    if preview:
+        open(marker, 'w').close()
+    elif isfile(marker):
+        remove(marker)
+
+
+def is_preview(dst):
+    """True if the output file is a preview render that needs refining."""
+    return isfile(preview_path_for_dst(dst))
+
+
+def render_reason(src, dst, preview):
+    """
+    Get the reason an output file needs to be rendered, or None if it's
+    cached. Preview renders are good enough for a preview build, but get
+    refined by a full-quality build.
+    """
+    if not isfile(dst):
+        return 'does not exist'
+    if is_dirty(src, dst):
+        return 'dirty'
+    if not preview and is_preview(dst):
+        return 'preview'
+    return None
+
+
 def is_dirty(src, dst):
     """
     True if the destination file is up-to-date with the source file.
@@ -324,9 +561,21 @@ def is_dirty(src, dst):
     return hash_file(src) != existing_hash
 
 
+def render_quality(preview):
+    """Get the name of a render's quality: 'preview' or 'full'."""
+    if preview:
+        return 'preview'
+    return 'full'
+
+
+def preview_resolutions(cfg):
+    """Get the smallest resolutions, which are all a preview build renders."""
+    return sorted(cfg.RESOLUTIONS)[:PREVIEW_RESOLUTIONS]
+
+
 # Major refactor target. This is too big.
 # Confusing naming between x_targets and x_jobs.
-def file_targets(cfg, src, is_video, dry_run):
+def file_targets(cfg, src, is_video, preview, dry_run):
     """
     Generate jobs for a single source media file.
     Returns a list of jobs for this source file, and the number of jobs
@@ -339,47 +588,46 @@ def file_targets(cfg, src, is_video, dry_run):
     skipped = 0
     name, ext = sanitary_name_and_ext(src)
     width, height = dimensions(src)
+    resolutions = cfg.RESOLUTIONS
+    if preview:
+        resolutions = preview_resolutions(cfg)
     if is_video:
         for fmt in cfg.VIDEO_FORMATS:
             ext = VIDEO_FMT_EXTS[fmt]
             for i, resolution in enumerate(cfg.RESOLUTIONS):
+                if resolution not in resolutions:
+                    continue
                 if resolution > width:
                     l.debug('Skipping {} @ {}: width {} < target resolution'
                             .format(name, resolution, width))
                     continue
                 bitrate = cfg.VIDEO_BITRATES[i]
                 full = name + '-' + str(resolution) + ext
-                dst = join(cfg.DST_DIR, target_dir(cfg, src), full)
-                if (not isfile(dst)) or is_dirty(src, dst):
-                    if not isfile(dst):
-                        reason = 'does not exist'
-                    else:
-                        reason = 'dirty'
+                dst = join(target_dir(cfg, src), full)
+                reason = render_reason(src, dst, preview)
+                if reason:
                     l.debug('Added target: {} @ {}px/{}M ({})'
                             .format(name, resolution, bitrate, reason))
                     job = VideoJob(cfg, src, dst, fmt, resolution, bitrate,
-                                   dry_run)
+                                   preview, dry_run)
                     targets.append(job)
                 else:
                     l.debug('Skipping {} @ {}: file exists and is cached'
                             .format(name, resolution))
                     skipped += 1
     else:
-        for resolution in cfg.RESOLUTIONS:
+        for resolution in resolutions:
             if resolution > width:
                 l.debug('Skipping {} @ {}: width {} < target resolution'
                         .format(name, resolution, width))
                 continue
             full = name + '-' + str(resolution) + ext
-            dst = join(cfg.DST_DIR, target_dir(cfg, src), full)
-            if (not isfile(dst)) or is_dirty(src, dst):
-                if not isfile(dst):
-                    reason = 'does not exist'
-                else:
-                    reason = 'dirty'
+            dst = join(target_dir(cfg, src), full)
+            reason = render_reason(src, dst, preview)
+            if reason:
                 l.debug('Added target: {} @ {}px ({})'
                         .format(name, resolution, reason))
-                job = ImageJob(src, dst, resolution, dry_run)
+                job = ImageJob(src, dst, resolution, preview, dry_run)
                 targets.append(job)
             else:
                 l.debug('Skipping {} @ {}: file exists and is cached'
@@ -388,7 +636,7 @@ def file_targets(cfg, src, is_video, dry_run):
     return targets, skipped
 
 
-def img_targets(cfg, src, dry_run):
+def img_targets(cfg, src, preview, dry_run):
     """
     Generate image jobs for a single source image file.
     Returns a list of jobs for this source file, and the number of jobs
@@ -396,10 +644,10 @@ def img_targets(cfg, src, dry_run):
 
     This method only works on image sources.
     """
-    return file_targets(cfg, src, False, dry_run)
+    return file_targets(cfg, src, False, preview, dry_run)
 
 
-def vid_targets(cfg, src, dry_run):
+def vid_targets(cfg, src, preview, dry_run):
     """
     Generate video jobs for a single source video file.
     Returns a list of jobs for this source file, and the number of jobs
@@ -407,11 +655,11 @@ def vid_targets(cfg, src, dry_run):
 
     This method only works on video sources.
     """
-    return file_targets(cfg, src, True, dry_run)
+    return file_targets(cfg, src, True, preview, dry_run)
 
 
-def media_jobs(cfg, dry_run, is_video):
-    """Generate either all image or all video jobs for a given config."""
+def media_jobs(cfg, sources, preview, dry_run, is_video):
+    """Generate either all image or all video jobs for a set of sources."""
     if is_video:
         media_lc = 'video'
         media_uc = 'Video'
@@ -427,13 +675,13 @@ def media_jobs(cfg, dry_run, is_video):
     jobs = []
     skipped = 0
 
-    si = src_media(cfg)
+    si = src_media(sources)
     if not si:
         l.debug('No source {}s'.format(media_lc))
         return
 
     for src in pyprind.prog_bar(si):
-        j, s = media_targets(cfg, src, dry_run)
+        j, s = media_targets(cfg, src.path, preview, dry_run)
         jobs.extend(j)
         skipped += s
 
@@ -443,14 +691,14 @@ def media_jobs(cfg, dry_run, is_video):
     return jobs
 
 
-def img_jobs(cfg, dry_run):
-    """Generate all image jobs for a given config."""
-    return media_jobs(cfg, dry_run, False)
+def img_jobs(cfg, sources, preview, dry_run):
+    """Generate all image jobs for a set of sources."""
+    return media_jobs(cfg, sources, preview, dry_run, False)
 
 
-def vid_jobs(cfg, dry_run):
-    """Generate all video jobs for a given config."""
-    return media_jobs(cfg, dry_run, True)
+def vid_jobs(cfg, sources, preview, dry_run):
+    """Generate all video jobs for a set of sources."""
+    return media_jobs(cfg, sources, preview, dry_run, True)
 
 
 def run_jobs(jobs, is_video):
@@ -496,24 +744,208 @@ def run_vid_jobs(jobs):
     run_jobs(jobs, True)
 
 
-def web_media_from_output(rendered_dir):
+def index_path(cfg):
+    """Get the path of the build index."""
+    return join(cfg.DST_DIR, INDEX_FILENAME)
+
+
+def settings_fingerprint(cfg):
+    """
+    Hash the settings that decide what gets rendered, so the build index can
+    be thrown out when any of them change.
+    """
+    settings = [cfg.TEMPLATE, cfg.IMAGE_PATTERNS, cfg.VIDEO_PATTERNS,
+                cfg.RESOLUTIONS, cfg.VIDEO_FORMATS, cfg.VIDEO_BITRATES,
+                cfg.VIDEO_VBR_MAX_RATIO, ENCODE_SETTINGS]
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()
+                          ).hexdigest()
+
+
+def load_index(cfg):
+    """
+    Load the build index, a dict of source paths relative to the source
+    directory to what was last rendered for them. Returns an empty index if
+    there isn't one yet, or if it was built with different render settings.
+    """
+    try:
+        with open(index_path(cfg)) as f:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if data.get('settings') != settings_fingerprint(cfg):
+        l.info('Render settings changed, checking every source')
+        return {}
+    return data['sources']
+
+
+def save_index(cfg, index, dry_run):
+    """Write the build index into the output directory."""
+    if dry_run:
+        l.info('Dry run: Writing {}'.format(index_path(cfg)))
+    else:
+        makedirs(cfg.DST_DIR, exist_ok=True)
+        with open(index_path(cfg), 'w') as f:
+            json.dump({'settings': settings_fingerprint(cfg),
+                       'sources': index}, f)
+
+
+def has_output_dir(cfg, entry):
+    """
+    True if the output directory recorded for an index entry is still on
+    disk, or if nothing was rendered for it. This is a single stat, so
+    checking every source stays cheap. Individual slices are only checked
+    once a source gets planned.
+    """
+    if not entry['slices']:
+        return True
+    return isdir(join(cfg.DST_DIR, *entry['path'].split('/')))
+
+
+def changed_sources(cfg, sources, index, preview):
+    """
+    List the sources that changed since they were last rendered, or whose
+    output directory has gone missing. A preview build counts previews as up
+    to date; a full build doesn't.
+    """
+    wanted = ('full',)
+    if preview:
+        wanted = ('preview', 'full')
+    changed = []
+    for source in sources:
+        entry = index.get(source.rel)
+        if (entry and entry['size'] == source.size and
+                entry['mtime'] == source.mtime and
+                entry['quality'] in wanted and
+                has_output_dir(cfg, entry)):
+            continue
+        changed.append(source)
+    return changed
+
+
+def output_slices(directory):
+    """List the names of the rendered slices in an output directory."""
+    try:
+        with scandir(directory) as entries:
+            return sorted(e.name for e in entries
+                          if e.name.endswith(SLICE_EXTS) and
+                          not e.name.startswith('.'))
+    except FileNotFoundError:
+        return []
+
+
+def update_index(cfg, index, sources, changed, quality, dry_run):
+    """
+    Record what was rendered for the changed sources and drop sources that
+    no longer exist. Only the changed sources' output directories are read.
+    Quality is 'preview', 'full', or None if nothing was rendered. A preview
+    only records its own resolutions, since any larger slices are left over
+    from before the source changed.
+
+    When sorting by capture time, sources without a recorded time get probed
+    for one. That's only the changed sources, unless the sort order was just
+    switched. Previews skip this and sort by modification time until they're
+    refined, so probing never holds up a preview site.
+    """
+    present = set(s.rel for s in sources)
+    for rel in [rel for rel in index if rel not in present]:
+        del index[rel]
+    for source in changed:
+        directory = target_dir(cfg, source.path)
+        slices = output_slices(directory)
+        if quality == 'preview':
+            slices = [name for name in slices
+                      if slice_width(name) in preview_resolutions(cfg)]
+        entry = {
+            'size': source.size,
+            'mtime': source.mtime,
+            'quality': quality,
+            'name': slide_name(cfg, source.path),
+            'path': '/'.join(relpath(directory, cfg.DST_DIR).split(sep)),
+            'slices': slices,
+        }
+        old = index.get(source.rel)
+        if (old and 'captured' in old and old['size'] == source.size and
+                old['mtime'] == source.mtime):
+            entry['captured'] = old['captured']
+        index[source.rel] = entry
+    if cfg.SORT_ORDER == 'capture' and quality != 'preview':
+        unprobed = [s for s in sources if 'captured' not in index[s.rel]]
+        for source, captured in zip(unprobed, capture_times(unprobed)):
+            index[source.rel]['captured'] = captured
+    save_index(cfg, index, dry_run)
+
+
+def migrate_unsharded_output(cfg, sources, dry_run):
+    """
+    Move output rendered before the output directory was sharded, from
+    DST_DIR/<name>/ into its sharded directory. Only sources at the top of the
+    source directory had output then. Hash files move along with the slices,
+    so slices that are still up to date don't get rendered again. If the
+    sharded directory already has slices, the old copy is removed instead.
+    """
+    for source in sources:
+        if sep in source.rel:
+            continue
+        old = join(cfg.DST_DIR, slide_name(cfg, source.path))
+        new = target_dir(cfg, source.path)
+        # Shard directories never hold slices themselves, so this can't
+        # mistake one for old output
+        if not output_slices(old):
+            continue
+        if output_slices(new):
+            if dry_run:
+                l.info('Dry run: remove {}'.format(old))
+            else:
+                l.info('Removing {}, already rendered to {}'.format(old, new))
+                rmtree(old)
+        else:
+            if dry_run:
+                l.info('Dry run: move {} to {}'.format(old, new))
+            else:
+                l.info('Moving {} to {}'.format(old, new))
+                if isdir(new):
+                    rmtree(new)
+                makedirs(dirname(new), exist_ok=True)
+                replace(old, new)
+
+
+def render_media(cfg, sources, index, preview, dry_run):
     """
-    Get WebMedia objects from a directory that contains directories for all
-    output media.
+    Generate and run image and video jobs for the sources that changed since
+    the last build, then update the build index.
     """
-    l.info('Gathering rendered media from {}'.format(rendered_dir))
-    media_globs = ['*.mp4', '*.jpg', '*.webm']
-    media_dirs = glob(join(rendered_dir, '*'))
+    changed = changed_sources(cfg, sources, index, preview)
+    l.info('{} of {} sources changed'.format(len(changed), len(sources)))
+    ij = img_jobs(cfg, changed, preview, dry_run)
+    vj = vid_jobs(cfg, changed, preview, dry_run)
+    run_img_jobs(ij)
+    run_vid_jobs(vj)
+    update_index(cfg, index, sources, changed, render_quality(preview),
+                 dry_run)
+
 
-    # Filter files out - static files may be lying around from the last build
-    media_dirs = [d for d in media_dirs if isdir(d)]
+def web_media_from_index(cfg, index):
+    """
+    Get WebMedia objects for every source in the build index that has
+    rendered output, in the configured sort order: 'path' or 'capture'.
+    """
+    l.info('Gathering rendered media for {} sources'.format(len(index)))
+    if cfg.SORT_ORDER == 'capture':
+        def capture_order(rel):
+            entry = index[rel]
+            return entry.get('captured', entry['mtime'] / 1e9), rel
+        order = sorted(index, key=capture_order)
+    else:
+        order = sorted(index)
 
     all_media = []
-    for mp in media_dirs:
-        media_paths = []
-        for ext in media_globs:
-            media_paths.extend(glob(join(mp, ext)))
-        wm = WebMedia(mp, media_paths)
+    for rel in order:
+        entry = index[rel]
+        if not entry['slices']:
+            continue
+        directory = join(cfg.DST_DIR, *entry['path'].split('/'))
+        media_paths = [join(directory, name) for name in entry['slices']]
+        wm = WebMedia(directory, media_paths, entry['name'], entry['path'])
         all_media.append(wm)
     return all_media
 
@@ -523,14 +955,172 @@ def template_dir(cfg):
     return join(TEMPLATES_DIR, cfg.TEMPLATE)
 
 
-def render_html_from_media(cfg, media, dry_run):
+def template_assets(cfg):
+    """
+    Load the asset manifest for the template in use. Templates without a
+    manifest get an empty one, so all their static files are copied as-is.
+    """
+    assets = {'vendor': {}, 'scripts': [], 'styles': [], 'files': []}
+    manifest = join(template_dir(cfg), ASSETS_FILENAME)
+    if isfile(manifest):
+        with open(manifest) as f:
+            assets.update(yaml.safe_load(f) or {})
+    return assets
+
+
+def vendor_dir(cfg):
+    """Get the directory holding the template's third-party assets."""
+    return join(template_dir(cfg), VENDOR_DIRNAME)
+
+
+def asset_path(cfg, name):
+    """Find an asset in the template directory, then the vendor directory."""
+    path = join(template_dir(cfg), name)
+    if isfile(path):
+        return path
+    return join(vendor_dir(cfg), name)
+
+
+def fetch_vendor_files(cfg, assets, dry_run):
+    """
+    Download the template's third-party assets into its vendor directory.
+    Each download is checked against the sha256 recorded in the manifest
+    before it's written, and files that are already there and match are left
+    alone. Exits with an error if an asset has no recorded sha256, can't be
+    fetched, or doesn't match.
+    """
+    unpinned = [name for name, vendored in assets['vendor'].items()
+                if not vendored.get('sha256')]
+    if unpinned:
+        l.error('No sha256 recorded in {} for: {}'
+                .format(ASSETS_FILENAME, ', '.join(unpinned)))
+        l.error('Record the published sha256 of each file, then re-run '
+                'this command.')
+        exit(1)
+
+    for name, vendored in assets['vendor'].items():
+        dst = join(vendor_dir(cfg), name)
+        expected = vendored['sha256']
+        if isfile(dst) and hash_file(dst) == expected:
+            l.debug('{} is up to date'.format(dst))
+            continue
+        if dry_run:
+            l.info('Dry run: fetch {} to {}'.format(vendored['url'], dst))
+            continue
+        l.info('Fetching {}'.format(vendored['url']))
+        try:
+            with urlopen(vendored['url']) as r:
+                data = r.read()
+        except OSError as e:
+            l.error('Could not fetch {} for the {} template: {}'
+                    .format(name, cfg.TEMPLATE, e))
+            exit(1)
+        actual = hashlib.sha256(data).hexdigest()
+        if actual != expected:
+            l.error('{} does not match the sha256 recorded in {}: expected '
+                    '{}, got {}'
+                    .format(vendored['url'], ASSETS_FILENAME, expected,
+                            actual))
+            exit(1)
+        makedirs(vendor_dir(cfg), exist_ok=True)
+        with open(dst, 'wb') as f:
+            f.write(data)
+
+
+def check_vendor_files(cfg, assets):
+    """
+    Make sure every third-party asset the template needs is already in its
+    vendor directory. Builds never fetch anything, so this exits with an
+    error explaining how to get the files if any are missing.
     """
-    Read output files and render HTML into the output directory.
+    missing = [name for name in assets['vendor']
+               if not isfile(join(vendor_dir(cfg), name))]
+    if missing:
+        l.error('Missing vendored assets for the {} template: {}'
+                .format(cfg.TEMPLATE, ', '.join(missing)))
+        l.error('Copy {} from a machine that has them, or run '
+                'expose.py --fetch-assets on a machine with network access.'
+                .format(vendor_dir(cfg)))
+        exit(1)
+
+
+def minify_js(source):
+    """
+    Strip indentation, blank lines and whole-line comments from a script.
+    Newlines are kept, since scripts may rely on automatic semicolon
+    insertion.
+    """
+    lines = (line.strip() for line in source.splitlines())
+    return '\n'.join(line for line in lines
+                     if line and not line.startswith('//'))
+
+
+def minify_css(source):
+    """Strip comments, indentation and blank lines from a stylesheet."""
+    source = re.sub(r'/\*.*?\*/', '', source, flags=re.DOTALL)
+    lines = (line.strip() for line in source.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+def read_asset(cfg, name):
+    """Read a template or vendored asset as text."""
+    with open(asset_path(cfg, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def inline_styles(cfg, assets):
+    """Concatenate and minify the template's styles for inlining into HTML."""
+    return '\n'.join(minify_css(read_asset(cfg, name))
+                     for name in assets['styles'])
+
+
+def build_script_bundle(cfg, assets, dry_run):
+    """
+    Concatenate the template's scripts, in manifest order, into a single
+    bundle in the output directory. Scripts that are already minified are
+    included untouched.
+    """
+    if not assets['scripts']:
+        return
+    bundle_out = join(cfg.DST_DIR, BUNDLE_FILENAME)
+    if dry_run:
+        l.info('Dry run: bundle {} scripts to {}'
+               .format(len(assets['scripts']), bundle_out))
+        return
+    l.info('Bundling {} scripts to {}'
+           .format(len(assets['scripts']), bundle_out))
+    sources = []
+    for name in assets['scripts']:
+        source = read_asset(cfg, name)
+        if not name.endswith('.min.js'):
+            source = minify_js(source)
+        sources.append(source)
+    # The semicolons guard against scripts that don't terminate their last
+    # statement
+    with open(bundle_out, 'w', encoding='utf-8') as f:
+        f.write('\n;\n'.join(sources))
+
+
+def render_html_from_media(cfg, media, metadata, assets, dry_run):
+    """
+    Read output files and render HTML into the output directory. Slide
+    descriptions and template styles are rendered straight into the page.
     """
     l.info('Rendering HTML from {} media items'.format(len(media)))
     env = Environment(loader=FileSystemLoader(template_dir(cfg)))
     template = env.get_template('index.html.jinja2')
-    rendered = template.render({'media': media})
+    slides = {}
+    if metadata:
+        slides = metadata.get('slides') or {}
+    bundle = None
+    if assets['scripts']:
+        bundle = BUNDLE_FILENAME
+    rendered = template.render({
+        'media': media,
+        'slides': slides,
+        'styles': inline_styles(cfg, assets),
+        'bundle': bundle,
+    })
     html_out = join(cfg.DST_DIR, 'index.html')
     if dry_run:
         l.info('Dry run: render HTML to {}'.format(html_out))
@@ -539,13 +1129,18 @@ def render_html_from_media(cfg, media, dry_run):
             f.write(rendered)
 
 
-def copy_template_static_files(cfg, dry_run):
+def copy_template_static_files(cfg, assets, dry_run):
     """
-    Copy the template's files into the output directory.
+    Copy the template's files into the output directory. Scripts and styles
+    that were bundled or inlined are skipped.
     """
     l.info('Copying static files for theme')
+    built = set([ASSETS_FILENAME] + assets['scripts'] + assets['styles'])
     static_files = [f for f in glob(join(template_dir(cfg), '*'))
-                    if not f.endswith('.jinja2')]
+                    if isfile(f) and not f.endswith('.jinja2') and
+                    basename(f) not in built]
+    static_files.extend(asset_path(cfg, name) for name in assets['files']
+                        if asset_path(cfg, name) not in static_files)
     for f in static_files:
         if dry_run:
             l.info('Dry run: copy {} to {}'.format(f, cfg.DST_DIR))
@@ -571,37 +1166,98 @@ def ordered_dump(data, stream=None, Dumper=yaml.Dumper, **kwds):
 def generate_metadata_template(cfg):
     """Generate an empty YAML metadata file from the available source media."""
     slides = {'slides': {}}
-    for pattern in cfg.IMAGE_PATTERNS + cfg.VIDEO_PATTERNS:
-        for f in glob(pattern):
-            slide = sanitary_name(f)
-            slides['slides'][slide] = {
-                'content': '',
-                'style': ''
-            }
+    for source in scan_sources(cfg):
+        slide = slide_name(cfg, source.path)
+        slides['slides'][slide] = {
+            'content': '',
+            'style': ''
+        }
     return ordered_dump(slides, default_flow_style=False)
 
 
-def copy_metadata(cfg, dry_run):
+def load_metadata(cfg):
     """
-    Copy metadata from source YAML to output JSON. Create a blank template
-    if none exists.
+    Read metadata from source YAML and pre-render each slide's markdown
+    content into an `html` key. Returns None if no metadata file exists.
     """
-    metadata = join(cfg.SRC_DIR, METADATA_FILENAME)
-    if isfile(metadata):
-        with open(metadata) as f:
-            metadata = json.dumps(yaml.load(f))
-            json_path = join(cfg.DST_DIR, 'metadata.json')
-            if dry_run:
-                l.info('Dry run: Writing {}'.format(json_path))
-            else:
-                l.info('Writing {}'.format(json_path))
-                with open(json_path, 'w') as j:
-                    j.write(metadata)
+    path = join(cfg.SRC_DIR, METADATA_FILENAME)
+    if not isfile(path):
+        return None
+    with open(path) as f:
+        metadata = yaml.safe_load(f) or {}
+    for slide in (metadata.get('slides') or {}).values():
+        if slide and slide.get('content'):
+            slide['html'] = markdown(slide['content'])
+    return metadata
+
+
+def copy_metadata(cfg, metadata, dry_run):
+    """
+    Copy metadata loaded from source YAML to output JSON. Create a blank
+    template if none exists.
+    """
+    if metadata is not None:
+        json_path = join(cfg.DST_DIR, 'metadata.json')
+        if dry_run:
+            l.info('Dry run: Writing {}'.format(json_path))
+        else:
+            l.info('Writing {}'.format(json_path))
+            with open(json_path, 'w') as j:
+                j.write(json.dumps(metadata))
     else:
         l.info('No {} found'.format(METADATA_FILENAME))
         create_template(cfg, dry_run)
 
 
+def precompress(path, dry_run):
+    """
+    Write .gz and .br siblings for a file so a static server can send them
+    without compressing on the fly. Brotli output needs the brotli module.
+    """
+    if dry_run:
+        l.info('Dry run: precompress {}'.format(path))
+        return
+    with open(path, 'rb') as f:
+        data = f.read()
+    # mtime=0 keeps the output identical across unchanged builds
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data))
+
+
+def precompress_site(cfg, dry_run):
+    """Precompress the text files at the top level of the output directory."""
+    l.info('Precompressing site files')
+    if not brotli:
+        l.debug('brotli not installed, skipping .br files')
+    for pattern in PRECOMPRESS_PATTERNS:
+        for path in glob(join(cfg.DST_DIR, pattern)):
+            precompress(path, dry_run)
+
+
+def build_site(cfg, index, dry_run):
+    """Build the HTML and static files for whatever media has been rendered."""
+    # These steps should be self-explanatory:
+    # Read the build index and make a list of media found
+    media = web_media_from_index(cfg, index)
+    # Find out which assets the template needs and make sure we have them
+    assets = template_assets(cfg)
+    check_vendor_files(cfg, assets)
+    # Read the metadata.yml and render its markdown
+    metadata = load_metadata(cfg)
+    # Render HTML from the media we just found
+    render_html_from_media(cfg, media, metadata, assets, dry_run)
+    # Bundle the template scripts and add the rest of the template files
+    build_script_bundle(cfg, assets, dry_run)
+    copy_template_static_files(cfg, assets, dry_run)
+    # Copy the metadata.yml into a metadata.json
+    copy_metadata(cfg, metadata, dry_run)
+    # Write .gz/.br versions of the HTML, JS, CSS and JSON
+    precompress_site(cfg, dry_run)
+
+
 def create_template(cfg, dry_run):
     """
     Create a blank metadata template unless a metadata file already exists.
@@ -657,6 +1313,7 @@ if __name__ == '__main__':
         VIDEO_BITRATES=[40, 24, 12, 7, 4, 2],
         VIDEO_FORMATS=['h264', 'webm'],
         VIDEO_VBR_MAX_RATIO=2,
+        SORT_ORDER='path',
     )
 
     # Dry run: don't write anything
@@ -671,22 +1328,38 @@ if __name__ == '__main__':
         else:
             exit(1)  # couldn't create template
 
+    # Fetch assets: download the template's third-party assets so later
+    # builds can run without network access
+    if args['--fetch-assets']:
+        l.info('Fetching assets for the {} template'.format(config.TEMPLATE))
+        fetch_vendor_files(config, template_assets(config), dry_run)
+        exit(0)
+
+    # Find all the source media, and what was rendered for it last time
+    l.info('Scanning {}'.format(config.SRC_DIR))
+    sources = scan_sources(config)
+    index = load_index(config)
+    # Without an index this may be the first build since output was sharded
+    if not index:
+        migrate_unsharded_output(config, sources, dry_run)
+
     # --site-only: useful for when you're tweaking your template, because
     # parsing image/video jobs can take a while
     if args['--site-only']:
         l.info('Skipping render phase')
+        update_index(config, index, sources,
+                     changed_sources(config, sources, index, False), None,
+                     dry_run)
+    elif args['--preview']:
+        # --preview: get a browsable site up quickly from small, fast renders,
+        # then keep going and replace them with full-quality renders. The
+        # site is rebuilt at the end to pick up the larger resolutions.
+        l.info('Rendering previews')
+        render_media(config, sources, index, True, dry_run)
+        build_site(config, index, dry_run)
+        l.info('Preview site built, refining media at full quality')
+        render_media(config, sources, index, False, dry_run)
     else:
-        ij = img_jobs(config, dry_run)
-        vj = vid_jobs(config, dry_run)
-        run_img_jobs(ij)
-        run_vid_jobs(vj)
+        render_media(config, sources, index, False, dry_run)
 
-    # These steps should be self-explanatory:
-    # Read the output dir and make a list of media found
-    media = web_media_from_output(config.DST_DIR)
-    # Render HTML from the media we just found
-    render_html_from_media(config, media, dry_run)
-    # Add the template files
-    copy_template_static_files(config, dry_run)
-    # Copy the metadata.yml into a metadata.json
-    copy_metadata(config, dry_run)
+    build_site(config, index, dry_run)
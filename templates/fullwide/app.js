@@ -70,23 +70,11 @@ document.addEventListener('lazybeforeunveil', function(e) {
   elem.innerHTML = html
 
   // add poster image while video loads
-  var poster = toPresent[0].split('.')[0] + '.jpg'
+  var poster = toPresent[0].replace(/\.[^./]+$/, '.jpg')
   elem.setAttribute('poster', poster)
 
 })
 
-// Request metadata and add it to the description elements
-$.getJSON('metadata.json').done(function(metadata) {
-  $.each(metadata.slides, function(key, val) {
-    var id = slidesById[key] + '_desc'
-    var elem = document.getElementById(id)
-    var content = val.content
-    var style = val.style
-    if (content) elem.innerHTML = markdown.toHTML(content)
-    if (style) elem.style.cssText = style
-  })
-})
-
 scrolledTo(1)
 
 $('.slide-desc').flowtype({
@@ -1,4 +1,13 @@
-from expose import Config, target_dir, hash_path_for_file
+from expose import (Config, slide_name, target_dir, hash_path_for_dst,
+                    preview_path_for_dst, preview_resolutions,
+                    settings_fingerprint, minify_js, minify_css, write_hash,
+                    mark_preview, render_reason, scan_sources,
+                    changed_sources, update_index, migrate_unsharded_output)
+
+from os import makedirs, utime
+from os.path import join, dirname, isfile, isdir
+from shutil import rmtree
+from tempfile import TemporaryDirectory
 
 import sure  # noqa
 
@@ -6,25 +15,184 @@ import sure  # noqa
 config = Config(
     SRC_DIR='/tmp',
     DST_DIR='output',
+    TEMPLATE='fullwide',
     IMAGE_PATTERNS=('*.jpg',),
     VIDEO_PATTERNS=('*.mp4',),
     RESOLUTIONS=(3840, 2560, 1920, 1280, 1024, 640),
     VIDEO_BITRATES=(40, 24, 12, 7, 4, 2),
     VIDEO_FORMATS=('h264', 'webm'),
     VIDEO_VBR_MAX_RATIO=2,
+    SORT_ORDER='path',
 )
 
 
+def test_slide_name():
+    expected = (
+        ('/tmp/my_file.jpg', 'my_file'),
+        ('/tmp/002 some file.jpg', '002-some-file'),
+        ('/tmp/2015/06 june/my_file.jpg', '2015/06-june/my_file'),
+    )
+    for in_fn, name in expected:
+        slide_name(config, in_fn).should.equal(name)
+
+
 def test_target_dir():
     expected = (
-        ('/usr/local/bin/my_file.jpg', 'output/my_file'),
-        ('/usr/local/bin/002 some file.jpg', 'output/002-some-file'),
-        ('/usr/local/bin/another_new file.jpg', 'output/another_new-file'),
+        ('/tmp/my_file.jpg', 'output/0b/my_file'),
+        ('/tmp/002 some file.jpg', 'output/80/002-some-file'),
+        ('/tmp/another_new file.jpg', 'output/de/another_new-file'),
+        ('/tmp/2015/06/my_file.jpg', 'output/6d/2015/06/my_file'),
     )
     for in_fn, out_dir in expected:
         target_dir(config, in_fn).should.equal(out_dir)
 
 
-def test_hash_path_for_file():
-    (hash_path_for_file('/usr/local/bin/my_file.txt')
+def test_hash_path_for_dst():
+    (hash_path_for_dst('/usr/local/bin/my_file.txt')
      .should.equal('/usr/local/bin/.my_file.txt.src.sha256'))
+
+
+def test_preview_path_for_dst():
+    (preview_path_for_dst('/usr/local/bin/my_file-640.jpg')
+     .should.equal('/usr/local/bin/.my_file-640.jpg.preview'))
+
+
+def test_preview_resolutions():
+    preview_resolutions(config).should.equal([640, 1024])
+
+
+def test_settings_fingerprint():
+    fingerprint = settings_fingerprint(config)
+    settings_fingerprint(config).should.equal(fingerprint)
+    (settings_fingerprint(config._replace(RESOLUTIONS=(1920, 640)))
+     .shouldnt.equal(fingerprint))
+
+
+def test_minify_js():
+    source = (
+        '// a comment\n'
+        '\n'
+        'function f() {\n'
+        '  return 1  // trailing comments stay\n'
+        '}\n'
+    )
+    (minify_js(source)
+     .should.equal('function f() {\nreturn 1  // trailing comments stay\n}'))
+
+
+def test_minify_css():
+    source = (
+        '/* a\n'
+        '   comment */\n'
+        'body {\n'
+        '  margin: 0;\n'
+        '}\n'
+    )
+    minify_css(source).should.equal('body {\nmargin: 0;\n}')
+
+
+def make_file(path, content='x'):
+    makedirs(dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def test_render_reason():
+    with TemporaryDirectory() as tmp:
+        src = join(tmp, 'src.jpg')
+        dst = join(tmp, 'out', 'src-640.jpg')
+        make_file(src)
+        render_reason(src, dst, False).should.equal('does not exist')
+
+        make_file(dst)
+        write_hash(src, dst)
+        render_reason(src, dst, False).should.be.none
+
+        mark_preview(dst, True)
+        render_reason(src, dst, True).should.be.none
+        render_reason(src, dst, False).should.equal('preview')
+
+        make_file(src, 'changed')
+        render_reason(src, dst, True).should.equal('dirty')
+
+
+def test_changed_sources_refines_previews():
+    with TemporaryDirectory() as tmp:
+        cfg = config._replace(SRC_DIR=join(tmp, 'src'),
+                              DST_DIR=join(tmp, 'out'))
+        make_file(join(cfg.SRC_DIR, 'a.jpg'))
+        sources = scan_sources(cfg)
+        index = {}
+        update_index(cfg, index, sources, sources, 'preview', True)
+        changed_sources(cfg, sources, index, True).should.equal([])
+        changed_sources(cfg, sources, index, False).should.equal(sources)
+
+
+def test_update_index_preview_records_preview_slices():
+    with TemporaryDirectory() as tmp:
+        cfg = config._replace(SRC_DIR=join(tmp, 'src'),
+                              DST_DIR=join(tmp, 'out'))
+        src = join(cfg.SRC_DIR, 'a.jpg')
+        make_file(src)
+        for width in (640, 1024, 3840):
+            make_file(join(target_dir(cfg, src), 'a-{}.jpg'.format(width)))
+        sources = scan_sources(cfg)
+        index = {}
+        update_index(cfg, index, sources, sources, 'preview', True)
+        index['a.jpg']['slices'].should.equal(['a-1024.jpg', 'a-640.jpg'])
+        update_index(cfg, index, sources, sources, 'full', True)
+        index['a.jpg']['slices'].should.equal(
+            ['a-1024.jpg', 'a-3840.jpg', 'a-640.jpg'])
+
+
+def test_scan_sources():
+    with TemporaryDirectory() as tmp:
+        cfg = config._replace(SRC_DIR=tmp, DST_DIR=join(tmp, '_site'))
+        for path in ('a.jpg', 'a.mp4', '2015/06/b.jpg', '2015/c.mp4',
+                     'notes.txt', '.hidden/d.jpg', '_site/e.jpg'):
+            make_file(join(tmp, path))
+        sources = scan_sources(cfg)
+        ([s.rel for s in sources]
+         .should.equal(['2015/06/b.jpg', '2015/c.mp4', 'a.jpg']))
+        [s.is_video for s in sources].should.equal([False, True, False])
+
+
+def test_changed_sources():
+    with TemporaryDirectory() as tmp:
+        cfg = config._replace(SRC_DIR=join(tmp, 'src'),
+                              DST_DIR=join(tmp, 'out'))
+        for name in ('a', 'b', 'c'):
+            src = join(cfg.SRC_DIR, name + '.jpg')
+            make_file(src)
+            make_file(join(target_dir(cfg, src), name + '-640.jpg'))
+        sources = scan_sources(cfg)
+        index = {}
+        changed_sources(cfg, sources, index, False).should.equal(sources)
+        update_index(cfg, index, sources, sources, 'full', True)
+        changed_sources(cfg, sources, index, False).should.equal([])
+
+        # a changes size, b changes mtime, c loses its output directory
+        make_file(join(cfg.SRC_DIR, 'a.jpg'), 'bigger')
+        utime(join(cfg.SRC_DIR, 'b.jpg'), (0, 0))
+        rmtree(target_dir(cfg, join(cfg.SRC_DIR, 'c.jpg')))
+        sources = scan_sources(cfg)
+        changed_sources(cfg, sources, index, False).should.equal(sources)
+
+
+def test_migrate_unsharded_output():
+    with TemporaryDirectory() as tmp:
+        cfg = config._replace(SRC_DIR=join(tmp, 'src'),
+                              DST_DIR=join(tmp, 'out'))
+        for name in ('a', 'b'):
+            make_file(join(cfg.SRC_DIR, name + '.jpg'))
+            make_file(join(cfg.DST_DIR, name, name + '-640.jpg'))
+        # b was already rendered into its sharded directory
+        b_dir = target_dir(cfg, join(cfg.SRC_DIR, 'b.jpg'))
+        make_file(join(b_dir, 'b-640.jpg'))
+
+        migrate_unsharded_output(cfg, scan_sources(cfg), False)
+        a_dir = target_dir(cfg, join(cfg.SRC_DIR, 'a.jpg'))
+        isfile(join(a_dir, 'a-640.jpg')).should.be.true
+        isdir(join(cfg.DST_DIR, 'a')).should.be.false
+        isfile(join(b_dir, 'b-640.jpg')).should.be.true
+        isdir(join(cfg.DST_DIR, 'b')).should.be.false